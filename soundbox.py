@@ -1,189 +1,261 @@
 import os
 import struct
-import crcmod
+import binascii
+import mmap
 import sys  # To handle command-line arguments
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 # Display the information line
 print("Soundbox Flash tools thijsnl 2024 v0.2")
 
-# Initialize the CRC-16-CCITT function (0x1021 polynomial, initial value 0x0000)
-crc16_ccitt = crcmod.mkCrcFun(0x11021, initCrc=0x0000, xorOut=0x0000, rev=False)
-
-# Function to parse a single entry (32 bytes)
-def parse_entry(entry_data):
-    # Unpack the first part of the entry: 2 CRCs (header & data), offset, size, type, unknown1
-    header_crc, data_crc, offset, size, type_flag, unknown1 = struct.unpack('<H H I I B 3s', entry_data[:16])
+# CRC-16-CCITT (0x1021 polynomial, initial value 0x0000), computed in C by binascii.
+# This is the same CRC XMODEM uses; every header and data CRC goes through this one function.
+crc16 = binascii.crc_hqx
+
+# Layout of a 32-byte entry: header CRC, data CRC, offset, size, type, unknown1, name
+ENTRY_STRUCT = struct.Struct('<H H I I B 3s 16s')
+ENTRY_SIZE = ENTRY_STRUCT.size
+
+# The 30 bytes following the header CRC, which the header CRC is calculated over
+HEADER_STRUCT = struct.Struct('<H I I B 3s 16s')
+
+# The header CRC that prefixes each entry
+CRC_STRUCT = struct.Struct('<H')
+
+# Entry type flags
+ENTRY_TYPES = {0x02: 'File', 0x03: 'Directory'}
+
+# Value of unknown1 (bytes 13-15 of an entry) that marks the last entry
+LAST_ENTRY_MARKER = b'\xFF\x01\x00'
+
+# A parsed 32-byte entry; slots keep the per-entry footprint small compared to a dict
+@dataclass(slots=True)
+class Entry:
+    header_crc: int
+    data_crc: int
+    offset: int
+    size: int
+    type: str
+    name: str
+    unknown1_bytes: bytes
+    entry_off: int  # Offset of the 30 bytes after the header CRC (for CRC check)
+
+# Function to parse a single entry from its unpacked fields and its position in the file
+def parse_entry(fields, entry_offset):
+    header_crc, data_crc, offset, size, type_flag, unknown1, name = fields
     
-    # Extract the file/directory name and remove null termination
-    name = entry_data[16:32].split(b'\x00', 1)[0].decode('utf-8')
+    # Remove null termination from the file/directory name
+    name = name.split(b'\x00', 1)[0].decode('utf-8')
     
     # Interpret the type flag
-    entry_type = 'File' if type_flag == 0x02 else 'Directory' if type_flag == 0x03 else 'Unknown'
+    entry_type = ENTRY_TYPES.get(type_flag, 'Unknown')
     
-    return {
-        'HeaderCRC': header_crc,
-        'DataCRC': data_crc,
-        'Offset': offset,
-        'Size': size,
-        'Type': entry_type,
-        'Name': name,
-        'Unknown1_bytes': unknown1,
-        'EntryData': entry_data[2:]  # The 30 bytes after the header CRC (for CRC check)
-    }
+    return Entry(header_crc, data_crc, offset, size, entry_type, name, unknown1, entry_offset + 2)
 
 # Function to calculate and verify the header CRC
-def verify_header_crc(entry):
-    # Calculate the CRC over the 30 bytes following the header CRC (entry['EntryData'])
-    calculated_crc = crc16_ccitt(entry['EntryData'])
+def verify_header_crc(entry, data):
+    # Calculate the CRC over the 30 bytes following the header CRC, starting at entry.entry_off
+    # The slice is released on exit, so no view into the mapped file outlives this call
+    with data[entry.entry_off:entry.entry_off + HEADER_STRUCT.size] as header_data:
+        calculated_crc = crc16(header_data, 0)
     
     # Compare the calculated CRC with the stored header CRC
-    if calculated_crc == entry['HeaderCRC']:
+    if calculated_crc == entry.header_crc:
         return "Header CRC OK"
     else:
-        return f"Header CRC Mismatch (Calculated CRC: 0x{calculated_crc:04X}, Expected CRC: 0x{entry['HeaderCRC']:04X})"
+        return f"Header CRC Mismatch (Calculated CRC: 0x{calculated_crc:04X}, Expected CRC: 0x{entry.header_crc:04X})"
 
 # Function to calculate and verify the data CRC
-def verify_data_crc(entry, data):
-    # Extract data from 'Offset' and 'Size' fields
-    offset = entry['Offset']
-    size = entry['Size']
+# crc_cache maps (offset, size) to the calculated CRC, so regions shared by several entries are only hashed once
+def verify_data_crc(entry, data, crc_cache):
+    # Extract data from the offset and size fields
+    offset = entry.offset
+    size = entry.size
 
     # Hack because the only directory needs to be truncated by 32 bytes to get a proper CRC returned.
-    if (entry['Type'] == 'Directory'):
+    if (entry.type == 'Directory'):
         size -= 32;
 
-    file_data = data[offset:offset + size]
-    
-    # Calculate the data CRC using CRC-16-XMODEM over the file data
-    calculated_data_crc = crc16_ccitt(file_data)
+    # Calculate the data CRC using CRC-16-CCITT over the file data, unless this region was already hashed
+    calculated_data_crc = crc_cache.get((offset, size))
+    if calculated_data_crc is None:
+        with data[offset:offset + size] as file_data:
+            calculated_data_crc = crc16(file_data, 0)
+        crc_cache[(offset, size)] = calculated_data_crc
     
-    # Compare the calculated data CRC with the stored DataCRC
-    if calculated_data_crc == entry['DataCRC']:
+    # Compare the calculated data CRC with the stored data CRC
+    if calculated_data_crc == entry.data_crc:
         return "Data CRC OK"
     else:
-        return f"Data CRC Mismatch (Calculated CRC: 0x{calculated_data_crc:04X}, Expected CRC: 0x{entry['DataCRC']:04X})"
+        return f"Data CRC Mismatch (Calculated CRC: 0x{calculated_data_crc:04X}, Expected CRC: 0x{entry.data_crc:04X})"
 
 # Function to read and parse the binary file
 def read_bin_file(file_path):
-    entries = []
-    
+    # Map the file instead of reading it, so slices of it are views rather than copies
     with open(file_path, 'rb') as f:
-        data = f.read()
-        entry_size = 32
-        num_entries = len(data) // entry_size
-        
-        for i in range(num_entries):
-            entry_data = data[i * entry_size:(i + 1) * entry_size]
-            entry = parse_entry(entry_data)
-            
-            # Add each entry to the list
-            entries.append(entry)
-            
+        # An empty file cannot be mapped, and has no entries anyway
+        if os.fstat(f.fileno()).st_size == 0:
+            data = memoryview(b'')
+        else:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    num_entries = len(data) // ENTRY_SIZE
+
+    # Unpack the entry table in a single pass instead of slicing and unpacking per entry
+    entries = []
+    entry_offsets = range(0, num_entries * ENTRY_SIZE, ENTRY_SIZE)
+    with data[:num_entries * ENTRY_SIZE] as table:
+        for entry_offset, fields in zip(entry_offsets, ENTRY_STRUCT.iter_unpack(table)):
+            entries.append(parse_entry(fields, entry_offset))
+
             # Check if unknown1 equals 0xFF0100, indicating the last entry
-            if entry['Unknown1_bytes'] == b'\xFF\x01\x00':
+            if fields[5] == LAST_ENTRY_MARKER:
                 print("Last item found based on unknown1 == 0xFF0100. Stopping the process.")
                 break
 
-    # Print the entries with CRC check results in the original order
+    # Report the entries with CRC check results in the original order, written out in one go
+    data_crc_cache = {}
+    report_lines = []
+    crc_error = False
     for i, entry in enumerate(entries):
-        header_crc_status = verify_header_crc(entry)  # Perform header CRC check
-        data_crc_status = verify_data_crc(entry, data)  # Perform data CRC check
-        print(f"Entry {i + 1}: HeaderCRC=0x{entry['HeaderCRC']:04X}, DataCRC=0x{entry['DataCRC']:04X}, Offset={entry['Offset']}, Size={entry['Size']}, Type={entry['Type']}, Name={entry['Name']}, {header_crc_status}, {data_crc_status}")
+        header_crc_status = verify_header_crc(entry, data)  # Perform header CRC check
+        data_crc_status = verify_data_crc(entry, data, data_crc_cache)  # Perform data CRC check
+        report_lines.append(f"Entry {i + 1}: HeaderCRC=0x{entry.header_crc:04X}, DataCRC=0x{entry.data_crc:04X}, Offset={entry.offset}, Size={entry.size}, Type={entry.type}, Name={entry.name}, {header_crc_status}, {data_crc_status}")
 
         if (header_crc_status != "Header CRC OK" or data_crc_status != "Data CRC OK"):
-            print("CRC Error! Abort!")
-            exit();
+            report_lines.append("CRC Error! Abort!")
+            crc_error = True
+            break
+
+    if report_lines:
+        sys.stdout.write('\n'.join(report_lines) + '\n')
+
+    if crc_error:
+        exit();
 
     return entries, data
 
+# Function to release the mapped binary file returned by read_bin_file
+def close_bin_file(data):
+    mapping = data.obj
+    data.release()
+
+    # Empty files are not mapped by read_bin_file
+    if isinstance(mapping, mmap.mmap):
+        mapping.close()
+
+# Function to write the data of a single file entry to the output directory
+def extract_file(entry, data, output_dir):
+    # Extract file data based on offset and size
+    offset = entry.offset
+    size = entry.size
+
+    # Create the output file path
+    file_path = os.path.join(output_dir, entry.name)
+    
+    # Write the file data to the output path; the slice is released on exit, even if the write fails,
+    # so a traceback does not keep the mapped file from being closed
+    with data[offset:offset + size] as file_data, open(file_path, 'wb') as out_file:
+        out_file.write(file_data)
+
 # Function to extract files based on parsed entries
 def extract_files(entries, data, output_dir):
     # Ensure the output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    for entry in entries:
-        if entry['Type'] == 'File':
-            # Extract file data based on offset and size
-            offset = entry['Offset']
-            size = entry['Size']
-            file_data = data[offset:offset + size]
-
-            # Create the output file path
-            file_path = os.path.join(output_dir, entry['Name'])
-            
-            # Write the file data to the output path
-            with open(file_path, 'wb') as out_file:
-                out_file.write(file_data)
-                print(f"Extracted file: {entry['Name']} (Size: {entry['Size']} bytes)")
+    file_entries = [entry for entry in entries if entry.type == 'File']
+
+    # Entries sharing an output path would overwrite each other, so only the last one for each path is written.
+    # This also keeps them from racing on the same file in the thread pool. Paths are compared the way the
+    # filesystem would, so 'A.wav' and 'a.wav' count as the same file on case-insensitive systems.
+    file_paths = [os.path.normcase(os.path.normpath(entry.name)) for entry in file_entries]
+    last_entry_per_path = dict(zip(file_paths, file_entries))
+
+    # Write the files from a thread pool, as file I/O releases the GIL. Each file is reported in the original
+    # order once its data is written, and the lines gathered so far are still written out if a later file fails.
+    report_lines = []
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            writes = {path: executor.submit(extract_file, entry, data, output_dir) for path, entry in last_entry_per_path.items()}
+
+            for entry, path in zip(file_entries, file_paths):
+                writes[path].result()
+                report_lines.append(f"Extracted file: {entry.name} (Size: {entry.size} bytes)")
+    finally:
+        if report_lines:
+            sys.stdout.write('\n'.join(report_lines) + '\n')
 
 # Function to pad file data to be a multiple of 16 bytes
 def pad_to_multiple_of_16(file_data):
-    padding_needed = (16 - (len(file_data) % 16)) % 16  # Calculate how much padding is needed
-    return file_data + b'\xFF' * padding_needed  # Append padding bytes
+    # Round the length up to the next multiple of 16 and fill the remainder with padding bytes
+    return file_data.ljust((len(file_data) + 15) & ~15, b'\xFF')
 
 
 # Function to pack files back into the binary format
 def pack_files(output_bin_file, input_dir):
     entries = []
-    offset = 32 * (len(os.listdir(input_dir)) + 1)  # Start after all the headers and the directory entry
-    binary_data = b''
-    file_list = sorted(os.listdir(input_dir))  # Sorted list of files in the directory
+    # Sorted list of files in the directory; scandir caches the file type, so no extra stat per file is needed
+    with os.scandir(input_dir) as dir_entries:
+        file_list = sorted((dir_entry for dir_entry in dir_entries if dir_entry.is_file()), key=lambda dir_entry: dir_entry.name)
     num_files = len(file_list)
+    offset = 32 * (num_files + 1)  # Start after all the headers and the directory entry
+    binary_data = bytearray()
+    entries_crc = 0  # Running CRC over the file entries, continued over the file data for the directory entry
 
 
     # Iterate through all files in the soundbox directory
-    for i, file_name in enumerate(file_list):
-        file_path = os.path.join(input_dir, file_name)
-        if os.path.isfile(file_path):
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-                size = len(file_data)
-
-                # Pad the file data to a multiple of 16 bytes
-                file_data_padded = pad_to_multiple_of_16(file_data)
-                size_padded = len(file_data_padded)
-                
+    for i, dir_entry in enumerate(file_list):
+        file_name = dir_entry.name
+        with open(dir_entry.path, 'rb') as f:
+            file_data = f.read()
+            size = len(file_data)
+
+            # Pad the file data to a multiple of 16 bytes
+            file_data_padded = pad_to_multiple_of_16(file_data)
+            size_padded = len(file_data_padded)
+            
 
-            # Calculate data CRC using CRC-16-CCITT
-            data_crc = crc16_ccitt(file_data)
+        # Calculate data CRC using CRC-16-CCITT
+        data_crc = crc16(file_data, 0)
 
-            # Create header entry
-            entry_type = 0x02  # File type
+        # Create header entry
+        entry_type = 0x02  # File type
 
-            # Set unknown1 to b'\xFF\x01\x00' for the last file
-            unknown1 = b'\xFF\x01\x00' if i == num_files - 1 else b'\xFF\x00\x00'
+        # Set unknown1 to b'\xFF\x01\x00' for the last file
+        unknown1 = LAST_ENTRY_MARKER if i == num_files - 1 else b'\xFF\x00\x00'
 
-            entry_name = (file_name.encode('utf-8') + b'\x00').ljust(16, b'\xFF')[:16]  # Zero-padded file name (16 bytes)
-            
-            # Header without header CRC for the calculation
-            header_data = struct.pack('<H I I B 3s 16s', data_crc, offset, size, entry_type, unknown1, entry_name)
-            
-            # Calculate header CRC using CRC-16-CCITT over the 30-byte header data
-            header_crc = crc16_ccitt(header_data)
-            
-            # Full entry with CRCs
-            entry = struct.pack('<H', header_crc) + header_data
-            entries.append(entry)
+        entry_name = (file_name.encode('utf-8') + b'\x00').ljust(16, b'\xFF')[:16]  # Zero-padded file name (16 bytes)
+        
+        # Header without header CRC for the calculation
+        header_data = HEADER_STRUCT.pack(data_crc, offset, size, entry_type, unknown1, entry_name)
+        
+        # Calculate header CRC using CRC-16-CCITT over the 30-byte header data
+        header_crc = crc16(header_data, 0)
+        
+        # Full entry with CRCs
+        entry = CRC_STRUCT.pack(header_crc) + header_data
+        entries.append(entry)
+        entries_crc = crc16(entry, entries_crc)
 
-            
-            # Append the file data and update offset for the next file
-            binary_data += file_data_padded
-            offset += size_padded
+        
+        # Append the file data and update offset for the next file
+        binary_data.extend(file_data_padded)
+        offset += size_padded
 
     # Make the initial directory entry
     entry_name = ("test_dir".encode('utf-8') + b'\x00').ljust(16, b'\xFF')[:16]
-    data_crc = crc16_ccitt(b''.join(entries) + binary_data)
-    header_data = struct.pack('<H I I B 3s 16s', data_crc, 0x20, offset, 0x03, b'\xFF\x00\x00', entry_name)
-    header_crc = crc16_ccitt(header_data)
-    entry = struct.pack('<H', header_crc) + header_data
+    data_crc = crc16(binary_data, entries_crc)
+    header_data = HEADER_STRUCT.pack(data_crc, 0x20, offset, 0x03, b'\xFF\x00\x00', entry_name)
+    header_crc = crc16(header_data, 0)
+    entry = CRC_STRUCT.pack(header_crc) + header_data
     entries.insert(0,entry)
     offset += 32
 
     # Write the packed binary data to the output file
     with open(output_bin_file, 'wb') as out_bin:
-        for entry in entries:
-            out_bin.write(entry)
+        out_bin.writelines(entries)
         out_bin.write(binary_data)
 
     print(f"Packed files into {output_bin_file}.")
@@ -209,12 +281,16 @@ if __name__ == '__main__':
         # Read and parse the binary file
         entries, data = read_bin_file(bin_file_path)
 
-        # Extract files into the soundbox directory
-        extract_files(entries, data, output_directory)
+        try:
+            # Extract files into the soundbox directory
+            extract_files(entries, data, output_directory)
+        finally:
+            close_bin_file(data)
     elif '-p' in sys.argv:
         # Pack files from the soundbox directory
         pack_files(bin_file_path, output_directory)
     else:
         # Read and parse the binary file
         entries, data = read_bin_file(bin_file_path)
+        close_bin_file(data)
         print("File extraction skipped. Use '-e' argument to enable extraction.")